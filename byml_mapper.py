@@ -16,55 +16,50 @@ byml_mapper - Find relationships between actors in byml files
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import argparse
-from collections import defaultdict
-import fnmatch
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from collections.abc import Mapping
 import json
 import logging
-from concurrent.futures import ProcessPoolExecutor
+import mmap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, islice
 import os
-from pathlib import Path, PosixPath
+from pathlib import Path
 import pickle
+import shutil
+import struct
 import sys
 from textwrap import dedent
+from typing import Optional
 
 import oead
 
+MAX_CHUNKSIZE = 256
+BYML_MAGIC = (b"BY", b"YB")
+CACHE_DIR = Path(".cache")
+# Write order: files and dirs mark paths as done, so they go after the indices
+SHARDS = ("actors", "references", "by_hash", "by_gyaml", "files", "dirs")
 
-def find_actors(filepath, byml) -> set:
-    actors = set()
-    try:
-        all_actors = byml["Actors"]
-    except KeyError:
-        logging.debug(f"No actor key in byml {filepath}")
-        return actors
-    except TypeError:
-        logging.error(f"Invalid byml type (probably an array) {filepath}")
-        return actors
-
-    for actor in all_actors:
-        actors.add(
-            json.dumps(
-                {"Hash": actor["Hash"].v, "Gyaml": actor["Gyaml"]},
-                ensure_ascii=True,
-                sort_keys=True,
-            )
-        )
+# Unchanged directories are recognised by their ctime, which changes whenever an
+# entry is added or removed and, unlike mtime, can't be set back by tools that
+# restore timestamps (tar, unzip, rsync -a, ...). On Windows st_ctime is the
+# creation time, so every directory is scanned there
+SKIP_UNCHANGED_DIRS = os.name != "nt"
 
-    return actors
+_loaded_shards = {}
 
 
-def find_ai_group_references(filepath, byml) -> set:
-    references = set()
+def find_actors(all_actors) -> set:
+    # Gyaml names repeat across most actors; interning lets pickle write each once
+    return {(actor["Hash"].v, sys.intern(actor["Gyaml"])) for actor in all_actors}
 
-    try:
-        ai_groups = byml["AiGroups"]
-    except KeyError:
-        logging.debug(f"No AIGroups key in byml {filepath}")
-        return references
-    except TypeError:
-        logging.error(f"Invalid byml type (probably an array) {filepath}")
-        return references
 
+def find_ai_group_references(filepath, ai_groups) -> set:
+    references = set()
+
+    add = references.add
     for ai_group in ai_groups:
         try:
             all_references = ai_group["References"]
@@ -73,10 +68,10 @@ def find_ai_group_references(filepath, byml) -> set:
 
         for reference in all_references:
             try:
-                references.add(reference["Reference"].v)
+                add(reference["Reference"].v)
             except KeyError:
                 try:
-                    references.add(reference["InstanceName"])
+                    add(reference["InstanceName"])
                 except KeyError:
                     logging.warning(
                         f"Ref with no 'Reference' or 'InstanceName' key in {filepath}"
@@ -85,49 +80,64 @@ def find_ai_group_references(filepath, byml) -> set:
     return references
 
 
-def find_generic_array_references(filepath, key, byml) -> set:
-    references = set()
+def find_generic_array_references(groups) -> set:
+    return {id_.v for group in groups for id_ in group}
 
-    try:
-        groups = byml[key]
-    except KeyError:
-        logging.debug(f"No {key} key in byml {filepath}")
-        return references
-    except TypeError:
-        logging.error(f"Invalid byml type (probably an array) {filepath}")
-        return references
 
-    for group in groups:
-        for id_ in group:
-            references.add(id_.v)
+def read_match(filepath) -> Optional[mmap.mmap]:
+    with open(filepath, "rb") as matched_file:
+        # Skip mapping (and parsing) files that can't be byml at all
+        if matched_file.read(2) not in BYML_MAGIC:
+            return None
+        data = mmap.mmap(matched_file.fileno(), 0, access=mmap.ACCESS_READ)
 
-    return references
+    # Start paging the file in now so it's resident by the time it's parsed
+    if hasattr(mmap, "MADV_WILLNEED"):
+        data.madvise(mmap.MADV_WILLNEED)
+    return data
 
 
-def process_match(filepath) -> tuple[set, set]:
+def process_match(filepath, data) -> tuple[set, set]:
     discovered_references = set()
 
-    with open(filepath, "rb") as matched_file:
+    if data is None:
+        logging.error(f"Not a byml file {filepath}")
+        return set(), set()
+
+    # oead copies everything it needs out of the buffer, so it can be unmapped
+    # as soon as parsing is done
+    with data:
         try:
-            byml = oead.byml.from_binary(matched_file.read())
+            byml = oead.byml.from_binary(data)
         except oead.InvalidDataError:
             logging.error(f"Unable to parse byml in {filepath}")
             return set(), set()
 
-    actors = find_actors(filepath, byml)
+    if not isinstance(byml, oead.byml.Hash):
+        logging.error(f"Invalid byml type (probably an array) {filepath}")
+        return set(), set()
 
-    ai_group_refs_in_file = find_ai_group_references(filepath, byml)
-    discovered_references.update(ai_group_refs_in_file)
+    # Check which sections exist up front instead of catching a KeyError per section
+    actors = find_actors(byml["Actors"]) if "Actors" in byml else set()
 
-    far_delete_groups_in_file = find_generic_array_references(
-        filepath, "FarDeleteGroups", byml
-    )
-    discovered_references.update(far_delete_groups_in_file)
+    ai_group_refs_in_file = set()
+    if "AiGroups" in byml:
+        ai_group_refs_in_file = find_ai_group_references(filepath, byml["AiGroups"])
+        discovered_references.update(ai_group_refs_in_file)
 
-    simultaneous_groups_in_file = find_generic_array_references(
-        filepath, "SimultaneousGroups", byml
-    )
-    discovered_references.update(simultaneous_groups_in_file)
+    far_delete_groups_in_file = set()
+    if "FarDeleteGroups" in byml:
+        far_delete_groups_in_file = find_generic_array_references(
+            byml["FarDeleteGroups"]
+        )
+        discovered_references.update(far_delete_groups_in_file)
+
+    simultaneous_groups_in_file = set()
+    if "SimultaneousGroups" in byml:
+        simultaneous_groups_in_file = find_generic_array_references(
+            byml["SimultaneousGroups"]
+        )
+        discovered_references.update(simultaneous_groups_in_file)
 
     total_refs = (
         len(ai_group_refs_in_file)
@@ -139,121 +149,387 @@ def process_match(filepath) -> tuple[set, set]:
     return actors, discovered_references
 
 
-def generate_cache(threads, dump_path):
-    cached_results = defaultdict(dict)
+def process_matches(filepaths) -> list[tuple[str, set, set]]:
+    # Map the next file in a thread while the current one is parsed. Only one file
+    # is read ahead, so at most two are mapped at a time. The kernel pages the next
+    # file in from its MADV_WILLNEED in the background, so disk reads overlap with
+    # parsing even if oead holds the GIL
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_data = reader.submit(read_match, filepaths[0]) if filepaths else None
+        for i, filepath in enumerate(filepaths):
+            data = next_data.result()
+            if i + 1 < len(filepaths):
+                next_data = reader.submit(read_match, filepaths[i + 1])
+            results.append((filepath, *process_match(filepath, data)))
+    return results
+
+
+def _iter_byml(root, known_dirs, scanned_dirs):
+    # known_dirs maps each directory from previous runs to (ctime, subdirectories).
+    # A directory whose ctime is unchanged has no new files, so only its
+    # subdirectories need to be walked.
+    # Paths are yielded in normalized POSIX form (as Path(...).as_posix() gives),
+    # so "dump", "./dump" and "dump/" all produce the same cache keys
+    stack = [Path(root).as_posix()]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            ctime = os.stat(dirpath).st_ctime_ns
+        except FileNotFoundError:
+            continue
+
+        known = known_dirs.get(dirpath)
+        if known is not None and known[0] == ctime:
+            stack.extend(known[1])
+            continue
+
+        prefix = "" if dirpath == "." else f"{dirpath.rstrip('/')}/"
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(prefix + entry.name)
+                    elif entry.name.endswith(".byml"):
+                        yield prefix + entry.name
+        except OSError as e:
+            # Like os.walk, keep going past unreadable directories. They aren't
+            # recorded as scanned, so they are listed again on the next run
+            logging.warning(f"Unable to scan directory {dirpath}: {e}")
+            stack.extend(subdirs)
+            continue
+        stack.extend(subdirs)
+        scanned_dirs[dirpath] = (ctime, tuple(subdirs))
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _chunksize(filepaths, workers):
+    # Aim for ~4 chunks per worker. The total isn't known while walking, but only
+    # enough paths to reach MAX_CHUNKSIZE need to be seen to size the chunks
+    head = list(islice(filepaths, workers * 4 * MAX_CHUNKSIZE + 1))
+    chunksize, extra = divmod(len(head), workers * 4)
+    chunksize += bool(extra)
+    return max(1, min(chunksize, MAX_CHUNKSIZE)), chain(head, filepaths)
+
+
+def _map_batches(executor, batches, max_pending):
+    # Like executor.map, but only keeps max_pending batches in flight so the walk
+    # is consumed as workers free up rather than all at once
+    pending = deque()
+    for batch in batches:
+        pending.append(executor.submit(process_matches, batch))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class ReferenceIndex(Mapping):
+    """
+    Read-only ref -> set of paths mapping backed by flat buffers, so it pickles as a
+    few out-of-band buffers instead of one set per ref. Sets are built on lookup
+    """
+
+    def __init__(self, refs, blob, path_ends, ref_ends, path_ids):
+        self._refs = refs
+        self._blob = memoryview(blob).cast("B")
+        self._path_ends = memoryview(path_ends).cast("B").cast("Q")
+        self._ref_ends = memoryview(ref_ends).cast("B").cast("Q")
+        self._path_ids = memoryview(path_ids).cast("B").cast("Q")
+        self._positions = {ref: i for i, ref in enumerate(refs)}
+        self._paths = {}
+
+    @classmethod
+    def from_dict(cls, references):
+        path_ids = {}
+        encoded = []
+        path_ends = array("Q")
+        end = 0
+        for paths in references.values():
+            for path_ in paths:
+                if path_ not in path_ids:
+                    path_ids[path_] = len(encoded)
+                    encoded.append(path_.encode("utf-8", "surrogateescape"))
+                    end += len(encoded[-1])
+                    path_ends.append(end)
+
+        refs = list(references)
+        ref_ends = array("Q")
+        ref_path_ids = array("Q")
+        for ref in refs:
+            ref_path_ids.extend(path_ids[path_] for path_ in references[ref])
+            ref_ends.append(len(ref_path_ids))
+
+        return cls(refs, b"".join(encoded), path_ends, ref_ends, ref_path_ids)
+
+    def _path(self, path_id):
+        try:
+            return self._paths[path_id]
+        except KeyError:
+            start = self._path_ends[path_id - 1] if path_id else 0
+            path_ = sys.intern(
+                bytes(self._blob[start : self._path_ends[path_id]]).decode(
+                    "utf-8", "surrogateescape"
+                )
+            )
+            self._paths[path_id] = path_
+            return path_
+
+    def __getitem__(self, ref):
+        i = self._positions[ref]
+        start = self._ref_ends[i - 1] if i else 0
+        return {
+            self._path(path_id) for path_id in self._path_ids[start : self._ref_ends[i]]
+        }
+
+    def __iter__(self):
+        return iter(self._refs)
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __reduce_ex__(self, protocol):
+        wrap = pickle.PickleBuffer if protocol >= 5 else bytes
+        buffers = (self._blob, self._path_ends, self._ref_ends, self._path_ids)
+        return type(self), (self._refs, *map(wrap, buffers))
+
+
+class HashIndex:
+    """
+    Actors sorted by hash. Hashes are kept in one array("Q") that is binary searched
+    and pickled out-of-band, with (gyaml, path) records in the same order
+    """
+
+    def __init__(self, hashes, records):
+        self._hashes = memoryview(hashes).cast("B").cast("Q")
+        self._records = records
+
+    @classmethod
+    def from_actors(cls, all_actors):
+        actors = sorted(all_actors.items())
+        hashes = array("Q", (hash_ for (hash_, _), _ in actors))
+        records = [(gyaml, path_) for (_, gyaml), path_ in actors]
+        return cls(hashes, records)
+
+    def get(self, hash_) -> list[tuple[str, str]]:
+        start = bisect_left(self._hashes, hash_)
+        end = bisect_right(self._hashes, hash_, start)
+        return self._records[start:end]
+
+    def __reduce_ex__(self, protocol):
+        wrap = pickle.PickleBuffer if protocol >= 5 else bytes
+        return type(self), (wrap(self._hashes), self._records)
+
+
+class _ShardUnpickler(pickle.Unpickler):
+    # Shards written while running as a script refer to __main__, so resolve the
+    # index classes here whether this file is run directly or imported
+    def find_class(self, module, name):
+        if module in ("__main__", __name__) and name in ("ReferenceIndex", "HashIndex"):
+            return globals()[name]
+        return super().find_class(module, name)
+
+
+def load_shard(name):
+    # Shard layout: pickle stream, out-of-band buffers, buffer lengths, buffer count
+    with open(CACHE_DIR / f"{name}.pkl", "rb") as shard_file:
+        shard_file.seek(-8, os.SEEK_END)
+        (count,) = struct.unpack("<Q", shard_file.read(8))
+        shard_file.seek(-8 * (count + 1), os.SEEK_END)
+        lengths = struct.unpack(f"<{count}Q", shard_file.read(8 * count))
+
+        shard_file.seek(-8 * (count + 1) - sum(lengths), os.SEEK_END)
+        buffers = []
+        for length in lengths:
+            buffer = bytearray(length)
+            shard_file.readinto(buffer)
+            buffers.append(buffer)
+
+        shard_file.seek(0)
+        return _ShardUnpickler(shard_file, buffers=buffers).load()
+
+
+def cached_shard(name):
+    # Searches only read shards, so each one is loaded at most once per process.
+    # generate_cache mutates what it loads and uses load_shard directly
+    try:
+        return _loaded_shards[name]
+    except KeyError:
+        shard = _loaded_shards[name] = load_shard(name)
+        return shard
+
+
+def dump_shard(name, obj):
+    _loaded_shards.pop(name, None)
+    CACHE_DIR.mkdir(exist_ok=True)
+    shard_path = CACHE_DIR / f"{name}.pkl"
+    tmp_path = shard_path.with_suffix(".tmp")
+    try:
+        with open(tmp_path, "wb") as shard_file:
+            buffers = []
+            pickle.dump(obj, shard_file, protocol=5, buffer_callback=buffers.append)
+
+            lengths = []
+            for buffer in buffers:
+                raw = buffer.raw()
+                shard_file.write(raw)
+                lengths.append(raw.nbytes)
+            shard_file.write(struct.pack(f"<{len(lengths)}QQ", *lengths, len(lengths)))
+            shard_file.flush()
+            os.fsync(shard_file.fileno())
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    # Swap the shard in whole so an interrupted write never leaves a partial file
+    os.replace(tmp_path, shard_path)
+
 
-    cached_filepaths = set()
+def generate_cache(threads, dump_path):
+    cached_filepaths = frozenset()
+    known_dirs = dict()
     all_actors = dict()
-    all_references = defaultdict(set)
+    all_references = dict()
+    by_gyaml = defaultdict(dict)
 
+    # Only shards touched by new files are rewritten, unless the cache is new
+    changed_shards = set()
     try:
-        with open(".cached_results", "rb") as cached_results_file:
-            cached_results = pickle.load(cached_results_file)
-        all_actors = cached_results["actors"]
-        all_references = cached_results["references"]
-        cached_filepaths = cached_results["files"]
+        all_actors = load_shard("actors")
+        all_references = load_shard("references")
+        cached_filepaths = frozenset(load_shard("files"))
+        by_gyaml = load_shard("by_gyaml")
     except (OSError, FileNotFoundError):
         logging.debug("Cache not found")
-
-    extensions = ["*.byml"]
-    paths = [dump_path]
-
-    matched_filepaths = []
-    logging.info("Finding files. . .")
-    for path in paths:
-        for root, dirs, files in os.walk(path):
-            for file_ in files:
-                for ext in extensions:
-                    if fnmatch.fnmatch(file_, ext):
-                        new_filepath = Path(root, file_)
-                        if new_filepath.as_posix() not in cached_filepaths:
-                            matched_filepaths.append(new_filepath)
-    logging.info(
-        f"Found {len(matched_filepaths)} new files ({len(cached_filepaths)} cached)"
+        changed_shards.update(SHARDS)
+    else:
+        # Skipping directories is only safe if their files are in the cache
+        if SKIP_UNCHANGED_DIRS:
+            try:
+                known_dirs = load_shard("dirs")
+            except (OSError, FileNotFoundError):
+                logging.debug("Directory cache not found")
+
+    scanned_dirs = dict()
+    new_filepaths = (
+        filepath
+        for filepath in _iter_byml(dump_path, known_dirs, scanned_dirs)
+        if filepath not in cached_filepaths
     )
 
-    if len(matched_filepaths) == 0:
-        return
-
-    logging.info("Processing files. . .")
-    chunksize = len(matched_filepaths) // (2 * threads)
-    logging.debug(f"Using {chunksize} chunks with {threads} threads")
+    logging.info(f"Processing new files ({len(cached_filepaths)} cached). . .")
+    chunksize, new_filepaths = _chunksize(new_filepaths, threads)
+    logging.debug(f"Using {chunksize} files per chunk with {threads} threads")
+    # Each new file shows up once per run, so paths can be appended without dedupe
+    new_references = defaultdict(list)
+    processed_filepaths = []
     with ProcessPoolExecutor(max_workers=threads) as p:
-        for pool_res in zip(
-            matched_filepaths,
-            p.map(process_match, matched_filepaths, chunksize=chunksize),
+        for batch_res in _map_batches(
+            p, _batched(new_filepaths, chunksize), 2 * threads
         ):
-            path_, file_data = pool_res
-            actors, refs = file_data
+            for path_, actors, refs in batch_res:
+                path_ = sys.intern(path_)
+
+                if actors:
+                    changed_shards.update(("actors", "by_hash", "by_gyaml"))
+                if refs:
+                    changed_shards.add("references")
 
-            for actor in actors:
-                all_actors[actor] = path_
-            for ref in refs:
-                all_references[ref].add(path_)
+                for hash_, gyaml in actors:
+                    gyaml = sys.intern(gyaml)
+                    all_actors[hash_, gyaml] = path_
+                    by_gyaml[gyaml][hash_] = path_
+                for ref in refs:
+                    new_references[ref].append(path_)
 
-            cached_filepaths.add(path_.as_posix())
+                processed_filepaths.append(path_)
 
+    cached_filepaths = cached_filepaths.union(processed_filepaths)
     logging.info(
-        f"Processed {len(matched_filepaths)} new files ({len(cached_filepaths)} cached)"
+        f"Processed {len(processed_filepaths)} new files ({len(cached_filepaths)} cached)"
     )
 
+    if processed_filepaths:
+        changed_shards.add("files")
+    if scanned_dirs:
+        changed_shards.add("dirs")
+    if not SKIP_UNCHANGED_DIRS:
+        changed_shards.discard("dirs")
+    if not changed_shards:
+        return
+
     logging.info("Updating cache. . .")
-    with open(".cached_results", "wb") as cached_results_file:
-        pickle.dump(
-            {
-                "actors": all_actors,
-                "references": all_references,
-                "files": cached_filepaths,
-            },
-            cached_results_file,
-        )
+    shards = {
+        "actors": all_actors,
+        "references": all_references,
+        "files": cached_filepaths,
+        "dirs": {**known_dirs, **scanned_dirs},
+        "by_hash": None,
+        "by_gyaml": by_gyaml,
+    }
+    if "by_hash" in changed_shards:
+        shards["by_hash"] = HashIndex.from_actors(all_actors)
+    if "references" in changed_shards:
+        merged_references = defaultdict(set, all_references)
+        for ref, paths in new_references.items():
+            merged_references[ref].update(paths)
+        shards["references"] = ReferenceIndex.from_dict(merged_references)
+    for name in SHARDS:
+        if name in changed_shards:
+            logging.debug(f"Writing {name} shard")
+            dump_shard(name, shards[name])
 
 
 def search_for_refs(type_, item):
-    with open(".cached_results", "rb") as cached_results_file:
-        cached_results = pickle.load(cached_results_file)
-    all_actors = cached_results["actors"]
-    all_references = cached_results["references"]
+    all_references = cached_shard("references")
+
+    if type_ == "Hash":
+        try:
+            hash_ = int(item)
+        except ValueError:
+            return []
+        matches = [
+            (hash_, gyaml, actor_file)
+            for gyaml, actor_file in cached_shard("by_hash").get(hash_)
+        ]
+    else:
+        matches = [
+            (hash_, item, actor_file)
+            for hash_, actor_file in cached_shard("by_gyaml").get(item, {}).items()
+        ]
 
     found_references = []
-    for actor, actor_file in all_actors.items():
-        actor = json.loads(actor)
-
-        actor_val = actor[type_]
-        if isinstance(actor_val, int):
-            actor_val = str(actor_val)
-
-        if actor_val == item:
-            reference = {
-                "hash": actor["Hash"],
-                "gyaml": actor["Gyaml"],
-                "source": actor_file.as_posix(),
-            }
-            if refs := all_references[actor["Hash"]]:
-                reference["files"] = [r.as_posix() for r in refs]
-            found_references.append(reference)
+    for hash_, gyaml, actor_file in matches:
+        reference = {
+            "hash": hash_,
+            "gyaml": gyaml,
+            "source": actor_file,
+        }
+        if refs := all_references.get(hash_):
+            reference["files"] = list(refs)
+        found_references.append(reference)
 
     return found_references
 
 
 def debug_cache():
-    with open(".cached_results", "rb") as cached_results_file:
-        cached_results = pickle.load(cached_results_file)
-    all_actors = cached_results["actors"]
-    all_references = cached_results["references"]
-    cached_filepaths = cached_results["files"]
+    cached_filepaths = cached_shard("files")
 
     print(
-        PosixPath(
-            "wip/Banc/MainField/Cave/Cave_FirstPlateau_0001_GroupSet_000_Static.bcett.byml"
-        )
+        "wip/Banc/MainField/Cave/Cave_FirstPlateau_0001_GroupSet_000_Static.bcett.byml"
         in cached_filepaths
     )
 
 
 def main(args):
     if args.regenerate_cache:
-        Path(".cached_results").unlink(missing_ok=True)
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
 
     if args.action == "generate" or args.regenerate_cache or args.update_cache:
         if args.regenerate_cache:
@@ -318,6 +594,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--threads",
         "-t",
+        type=int,
         default=6,
         help="How many threads to use for building the cache",
     )